@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Measure how long `import writmacs` takes in a fresh interpreter.
+
+Each run uses an empty, read-only home directory, so importing must not
+touch the filesystem or load any keymaps. The median import time, timed
+inside the interpreter, is reported; pass --max-ms to fail when it
+regresses past a threshold.
+"""
+
+import argparse
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+PROBE = '''
+import time
+start = time.perf_counter()
+import writmacs
+elapsed = time.perf_counter() - start
+from writmacs.util import KEYMAP_CACHE
+assert len(KEYMAP_CACHE.cache) == 0, 'keymaps loaded at import'
+print(elapsed)
+'''
+
+
+def import_seconds(home: Path) -> float:
+    env = {'HOME': str(home), 'PYTHONPATH': str(REPO_DIR)}
+    done = subprocess.run(
+            [sys.executable, '-c', PROBE],
+            env=env, capture_output=True, text=True, check=True,
+            )
+    return float(done.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        home = Path(home)
+        home.chmod(0o555)
+        try:
+            times = [import_seconds(home) for __ in range(args.runs)]
+            created = list(home.iterdir())
+        finally:
+            home.chmod(0o755)
+
+    assert created == [], f'import created files: {created}'
+    median_ms = statistics.median(times) * 1000
+    print(f'import writmacs: {median_ms:.2f} ms median of {args.runs}')
+    if args.max_ms is not None and median_ms > args.max_ms:
+        print(f'slower than {args.max_ms} ms', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
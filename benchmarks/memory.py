@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Compare the memory held by parsed documents against the representation
+used before Nodes were slotted and shared between the AST and the
+semantic tree: a dict per macro in the AST plus a parallel tree of plain
+Node objects.
+"""
+
+import argparse
+from pathlib import Path
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from writmacs.expand import semantic_tree
+from writmacs.util import Node
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'elit']
+MACROS = ['em', 'mono', 'smallcaps', 'rot', 'under', 'sparkle']
+
+
+def corpus(size: int, seed: int = 0) -> str:
+    """Generate prose with a macro every few words, some of them nested."""
+    rng = random.Random(seed)
+    builder = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.2:
+            inner = ' '.join(rng.choices(WORDS, k=3))
+            if rng.random() < 0.3:
+                inner = f'%{rng.choice(MACROS)}{{{inner}}}'
+            chunk = f'%{rng.choice(MACROS)}{{{inner}}} '
+        else:
+            chunk = rng.choice(WORDS) + ' '
+        builder.append(chunk)
+        length += len(chunk)
+    return ''.join(builder)
+
+
+class LegacyNode:
+    def __init__(self, name, children, child_names={}):
+        self.name = name
+        self.children = children
+        self.fields = child_names
+
+
+def legacy_trees(tree: Node):
+    """Rebuild a tree as a dict AST and a separate plain Node tree."""
+    def copy(node):
+        ast = {'name': node.name, 'bracs': list(node.bracs), 'vals': []}
+        semantic = LegacyNode(node.name, [], {})
+        return ast, semantic
+
+    root_ast, root_semantic = copy(tree)
+    unvisited = [(tree, root_ast, root_semantic)]
+    while len(unvisited) > 0:
+        node, ast, semantic = unvisited.pop()
+        for forest in node.children:
+            ast_forest = []
+            semantic_forest = []
+            for item in forest:
+                if type(item) is Node:
+                    child_ast, child_semantic = copy(item)
+                    unvisited.append((item, child_ast, child_semantic))
+                    ast_forest.append(child_ast)
+                    semantic_forest.append(child_semantic)
+                else:
+                    ast_forest.append(item)
+                    semantic_forest.append(item)
+            ast['vals'].append(ast_forest)
+            semantic.children.append(semantic_forest)
+    return root_ast, root_semantic
+
+
+def held_bytes(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held, kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=2_000_000,
+            help='corpus size in characters')
+    args = parser.parse_args()
+
+    text = corpus(args.size)
+    legacy, kept = held_bytes(lambda: legacy_trees(semantic_tree(text)))
+    del kept
+    compact, kept = held_bytes(lambda: semantic_tree(text))
+
+    print(f'corpus:  {len(text):>12,} chars')
+    print(f'legacy:  {legacy:>12,} bytes  ({legacy / len(text):.1f}/char)')
+    print(f'compact: {compact:>12,} bytes  ({compact / len(text):.1f}/char)')
+    print(f'saved:   {1 - compact / legacy:.0%}')
+
+
+if __name__ == '__main__':
+    main()
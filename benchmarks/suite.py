@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Time each phase of expansion over reproducible synthetic corpora.
+
+For every corpus, parse, semantic_tree, and end-to-end expand are timed
+once, and eval_tree and expand once per target. Throughput is reported
+in characters per second from the best of several repeats, and peak
+memory from a separate traced run. Results are written as JSON so runs
+on different commits can be compared; pass an earlier run as --baseline
+to fail on throughput regressions.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from writmacs.expand import eval_tree, expand, semantic_tree
+from writmacs.parse import parse
+from writmacs.util import TARGETS
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'elit',
+         'sed', 'do', 'eiusmod', 'tempor', 'Incididunt', 'Labore']
+SMALL_MACROS = ['em', 'mono', 'under', 'sparkle', 'smallcaps', 'rot']
+KEYMAP_MACROS = ['smallcaps', 'rot', 'em', 'mono']
+# macros that accept each other's output in every target
+NESTABLE_MACROS = ['smallcaps', 'rot', 'under']
+
+
+def words(rng, size):
+    builder = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        builder.append(word)
+        length += len(word) + 1
+    return ' '.join(builder)
+
+
+def plain_prose(rng, size):
+    return words(rng, size)
+
+
+def dense_macros(rng, size):
+    builder = []
+    length = 0
+    while length < size:
+        chunk = f'%{rng.choice(SMALL_MACROS)}{{{rng.choice(WORDS)}}} '
+        builder.append(chunk)
+        length += len(chunk)
+    return ''.join(builder)
+
+
+def deep_nesting(rng, size):
+    depth = size // 12
+    names = [rng.choice(NESTABLE_MACROS) for __ in range(depth)]
+    return (
+        ''.join(f'%{name}{{' for name in names)
+        + 'center'
+        + '}' * depth
+    )
+
+
+def big_literals(rng, size):
+    builder = []
+    length = 0
+    while length < size:
+        chunk = f'%mono`{words(rng, 4096)}` '
+        builder.append(chunk)
+        length += len(chunk)
+    return ''.join(builder)
+
+
+def heavy_keymaps(rng, size):
+    builder = []
+    length = 0
+    while length < size:
+        chunk = f'%{rng.choice(KEYMAP_MACROS)}{{{words(rng, 200)}}} '
+        builder.append(chunk)
+        length += len(chunk)
+    return ''.join(builder)
+
+
+CORPORA = {
+    'plain-prose': plain_prose,
+    'dense-macros': dense_macros,
+    'deep-nesting': deep_nesting,
+    'big-literals': big_literals,
+    'heavy-keymaps': heavy_keymaps,
+}
+
+
+def best_seconds(fun, repeats):
+    best = float('inf')
+    for __ in range(repeats):
+        start = time.perf_counter()
+        fun()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_bytes(fun):
+    tracemalloc.start()
+    fun()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def measure(fun, size, repeats):
+    seconds = best_seconds(fun, repeats)
+    return {
+        'seconds': seconds,
+        'chars_per_second': size / seconds if seconds > 0 else None,
+        'peak_bytes': peak_bytes(fun),
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                capture_output=True, text=True, check=True,
+                ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=200_000,
+            help='approximate characters per corpus')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', action='append', choices=CORPORA,
+            help='only run the given corpora (repeatable)')
+    parser.add_argument('--output', type=Path,
+            default=Path('bench_output.json'))
+    parser.add_argument('--baseline', type=Path,
+            help='earlier results to compare throughput against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help='fraction of baseline throughput that may be lost')
+    args = parser.parse_args()
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'size': args.size,
+        'seed': args.seed,
+        'corpora': {},
+    }
+    for name in args.corpus or CORPORA:
+        text = CORPORA[name](random.Random(args.seed), args.size)
+        tree = semantic_tree(text)
+        phases = {
+            'parse': measure(lambda: parse(text), len(text), args.repeats),
+            'semantic_tree': measure(
+                lambda: semantic_tree(text), len(text), args.repeats
+            ),
+        }
+        for target in sorted(TARGETS):
+            context = {'target': target}
+            phases[f'eval_tree/{target}'] = measure(
+                    lambda: eval_tree(tree, context), len(text), args.repeats
+                    )
+            phases[f'expand/{target}'] = measure(
+                    lambda: expand(text, context), len(text), args.repeats
+                    )
+        results['corpora'][name] = {'chars': len(text), 'phases': phases}
+
+        for phase, result in phases.items():
+            print(f'{name:<14} {phase:<18} '
+                  f'{result["chars_per_second"] or 0:>14,.0f} chars/s '
+                  f'{result["peak_bytes"]:>14,} peak bytes')
+
+    args.output.write_text(json.dumps(results, indent=2) + '\n')
+    print(f'wrote {args.output}')
+
+    if args.baseline is not None:
+        regressions = compare(
+                json.loads(args.baseline.read_text()), results, args.tolerance
+                )
+        for regression in regressions:
+            print('regression:', regression, file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+def compare(baseline, results, tolerance):
+    """List the phases whose throughput fell too far below the baseline."""
+    regressions = []
+    for name, corpus in results['corpora'].items():
+        old_phases = baseline['corpora'].get(name, {}).get('phases', {})
+        for phase, result in corpus['phases'].items():
+            old = old_phases.get(phase, {}).get('chars_per_second')
+            new = result['chars_per_second']
+            if old and new and new < old * (1 - tolerance):
+                regressions.append(
+                        f'{name} {phase}: {new:,.0f} chars/s, was {old:,.0f}'
+                        )
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,18 @@
-from writmacs import expand
+from pathlib import Path
+import socket
+from tempfile import TemporaryDirectory
+from threading import Thread
+
+from writmacs import (
+    compile, expand, expand_all, expand_iter, expand_many, Memo, profiling,
+    DepthExceeded, OutputExceeded, Profile, TimeExceeded, Template
+)
+from writmacs import serial
+from writmacs.macros import contextualizers, expanders
+from writmacs.parse import parse
+from writmacs.server import respond, serve
+from writmacs import util
+from writmacs.util import DB, SnippetStore, load_keymap
 
 # Given this input, expect this output
 
@@ -62,6 +76,19 @@ assert studly[8] == 'L', (
     f"Studly case failed to render L as capital: {studly}"
 )
 
+## Seeded
+
+seeded = {'target': 'md', 'seed': 'Polkka'}
+for writ in ['%studly(Ievan Polkka)', '%zalgo(Ievan Polkka)']:
+    assert expand(writ, seeded) == expand(writ, seeded), (
+        f"Seeded output varies: {writ}"
+    )
+
+zalgo = expand('%zalgo(Polkka)')[0]
+assert zalgo[::9] == 'Polkka' and len(zalgo) == 54, (
+    f"Zalgo mangled the underlying text: {zalgo}"
+)
+
 # Breaking the rules must fail successfully
 
 try:
@@ -70,6 +97,293 @@ try:
 except:
     pass
 
+# Streaming must match whole-document expansion
+
+writ = 'Hello, %em{world}! %title{Greeting} %rot(upside-down text)'
+streamed = expand_iter(writ, {'target': 'html'})
+chunks = []
+while True:
+    try:
+        chunks.append(next(streamed))
+    except StopIteration as done:
+        streamed_meta = done.value
+        break
+whole, whole_meta = expand(writ, {'target': 'html'})
+assert ''.join(chunks) == whole, f"Streamed output differs: {chunks}"
+assert streamed_meta == whole_meta, f"Streamed metadata differs: {streamed_meta}"
+
+# Compiled templates must render like expand
+
+template = compile(writ)
+for target in all_cases.keys():
+    rendered = template.render({'target': target})
+    expanded = expand(writ, {'target': target})
+    assert rendered == expanded, f"Template differs for {target}: {rendered}"
+
+# Rendering every target at once must match rendering each alone
+
+for target, result in expand_all(writ).items():
+    expanded = expand(writ, {'target': target})
+    assert result == expanded, f"expand_all differs for {target}: {result}"
+
+# Memoized subtrees must render the same and be reused
+
+memo = Memo(maxsize=8)
+repeated = '%smallcaps{Sincerely} and %smallcaps{Sincerely}'
+assert expand(repeated, memo=memo) == expand(repeated), "Memo changed output"
+assert memo.hits == 1, f"Repeated subtree was not reused: {memo.hits} hits"
+expand('%studly{Ievan} %studly{Ievan}', memo=memo)
+assert memo.hits == 1, "Nondeterministic subtree was reused without a seed"
+expand('%studly{Ievan} %studly{Ievan}', {'target': 'md', 'seed': None}, memo)
+assert memo.hits == 1, "Nondeterministic subtree was reused with seed None"
+
+# a macro rendering its body in another target, so contexts differ
+contextualizers['as'] = lambda children: {'target': children[0][0]}
+expanders['as'] = lambda fields, __: (fields[1], {})
+for times in range(1, 6):
+    switched = ' '.join(
+        f'%as{{{target}}}{{%em{{x}}}}'
+        for target in ['html', 'txt', 'md'] * times
+    )
+    assert expand(switched, memo=Memo()) == expand(switched), (
+        "Memo mixed up contexts"
+    )
+    assert compile(switched).render() == expand(switched), (
+        "Contextualizer saw Spans of the source"
+    )
+del contextualizers['as'], expanders['as']
+
+# Batches must expand like single documents, in order
+
+batch = [writ, repeated, 'the %smallcaps{smallest of Caps}']
+expanded = [expand(doc, {'target': 'txt'}) for doc in batch]
+assert expand_many(batch, {'target': 'txt'}, workers=2, chunksize=1) == (
+    expanded
+), "Batch expansion differs from expand"
+
+# Expanding one document in parallel must keep order and later > earlier
+
+big = ' and '.join(batch * 8) + ' %title{Last}'
+assert expand(big, {'target': 'html'}, workers=2) == (
+    expand(big, {'target': 'html'})
+), "Parallel expansion differs from expand"
+
+for depth in [199, 2000]:
+    nest = 'a %smallcaps{' * depth + 'x' + '}' * depth
+    big = ' and '.join([nest] + batch * 8)
+    assert expand(big, {'target': 'txt'}, workers=2) == (
+        expand(big, {'target': 'txt'})
+    ), f"Parallel expansion differs from expand {depth} deep"
+
+# The daemon must answer like expand, with metadata as plain text
+
+answer = respond({'text': writ, 'target': 'html'})
+assert answer == {
+    'output': expand(writ, {'target': 'html'})[0],
+    'metadata': {'title': 'Greeting'},
+}, f"Daemon answered differently: {answer}"
+
+# A second daemon must not take over a socket that's in use
+
+with TemporaryDirectory() as tmp, socket.socket(socket.AF_UNIX) as listener:
+    in_use = Path(tmp) / 'writmacs.sock'
+    listener.bind(str(in_use))
+    listener.listen()
+    try:
+        serve(in_use)
+        raise Exception("Daemon started over one already listening")
+    except FileExistsError:
+        pass
+    assert in_use.is_socket(), "Socket in use was removed"
+
+# Profiles must count each macro dispatched
+
+with profiling() as profile:
+    expand(repeated)
+calls, __, chars = profile.macros['smallcaps']
+assert (calls, chars) == (2, 18), f"Unexpected smallcaps profile: {calls, chars}"
+assert set(profile.phases) == {'parse', 'join'}, profile.phases
+with profiling() as profile:
+    list(expand_iter('streamed prose only'))
+assert set(profile.phases) == {'parse', 'join'}, profile.phases
+
+# and only the expansions of their own thread
+with profiling() as profile:
+    elsewhere = Thread(target=expand, args=(repeated,))
+    elsewhere.start()
+    elsewhere.join()
+assert profile.macros == {}, f"Another thread was profiled: {profile.macros}"
+
+profile = Profile()
+def profile_many():
+    with profiling(profile):
+        for __ in range(50):
+            expand(repeated)
+profilers = [Thread(target=profile_many) for __ in range(4)]
+for profiler in profilers:
+    profiler.start()
+for profiler in profilers:
+    profiler.join()
+calls = profile.macros['smallcaps'][0]
+assert calls == 400, f"Profile lost counts across threads: {calls}"
+
+# Caches must not refetch misses or grow without bound
+
+fetched = []
+def fetch(key):
+    fetched.append(key)
+    return {} if key == 'absent' else {key: key.upper()}
+db = DB(fetch, maxsize=2)
+assert 'absent' not in db and db['absent'] is None, "Missing key was found"
+assert fetched == ['absent'], f"Missing key was fetched again: {fetched}"
+for key in ['a', 'b', 'c', 'c']:
+    db[key]
+assert list(db.cache) == ['b', 'c'], f"LRU eviction failed: {list(db.cache)}"
+assert db.stats()['evictions'] == 1, db.stats()
+db = DB(lambda key: {}, maxsize=2, stamp=lambda key: 0)
+for key in range(100):
+    db[key]
+assert len(db.missing) == 2 and len(db.stamps) == 2, "Misses grew unbounded"
+
+# Snippets must be found through the index and escaped per target
+
+with TemporaryDirectory() as tmp:
+    tmp = Path(tmp)
+    (tmp / 'snippets').mkdir()
+    (tmp / 'snippets' / 'signs.tsv').write_text(
+        '# name\ttext\nsig,signature\t_Kat_\nhi\thello\n'
+    )
+    store = SnippetStore(tmp / 'snippets', tmp / 'snippets.index')
+    assert store.get('signature', 'md') == r'\_Kat\_', store.get('sig', 'md')
+    assert store.get('hi', 'txt') == 'hello', store.get('hi', 'txt')
+    assert store.get('absent') is None, "Undefined snippet was found"
+    assert (tmp / 'snippets.index').exists(), "Snippet index wasn't saved"
+
+    (tmp / 'snippets' / 'crlf.tsv').write_bytes(b'crlf\tline\r\n')
+    assert store.get('crlf') is None, "Snippets rechecked too soon"
+    store.recheck = 0
+    assert store.get('crlf') == 'line', repr(store.get('crlf'))
+
+    # edited between rechecks, so the indexed offsets are stale
+    store.recheck = 60
+    (tmp / 'snippets' / 'moved.tsv').write_text('one\tfirst\ntwo\tsecond\n')
+    store.checked = None
+    assert store.get('one') == 'first', store.get('one')
+    (tmp / 'snippets' / 'moved.tsv').write_text(
+        'zero\tnew\none\tfirst\ntwo\tsecond\n'
+    )
+    assert store.get('two') == 'second', "Stale offset read the wrong row"
+    assert store.get('zero') == 'new', store.get('zero')
+    (tmp / 'snippets' / 'moved.tsv').write_text('t\n')
+    assert store.get('one') is None, "Snippet outlived its row"
+    (tmp / 'snippets' / 'moved.tsv').unlink()
+    store.recheck = 0
+    assert store.get('one') is None, "Snippet outlived its file"
+
+    index = (tmp / 'snippets.index').stat()
+    store = SnippetStore(tmp / 'snippets', tmp / 'snippets.index')
+    assert store.get('hi') == 'hello', store.get('hi')
+    assert (tmp / 'snippets.index').stat() == index, (
+        "Unchanged snippet index was rewritten"
+    )
+
+# Compiled keymaps cached on disk must go stale with the user's TSV
+
+with TemporaryDirectory() as tmp:
+    tmp = Path(tmp)
+    dirs = util.KEYMAPS_DIR, util.CACHE_DIR
+    util.KEYMAPS_DIR, util.CACHE_DIR = tmp / 'keymaps', tmp / 'cache'
+    try:
+        util.KEYMAPS_DIR.mkdir()
+        users_italic = util.KEYMAPS_DIR / 'italic.tsv'
+        users_italic.write_text('a\tA\n')
+        assert load_keymap('italic').apply('a') == 'A', "User keymap unused"
+        assert (util.CACHE_DIR / 'italic.keymap').exists(), "Not cached"
+        users_italic.write_text('a\tAA\n')
+        assert load_keymap('italic').apply('a') == 'AA', (
+            "Cached keymap outlived an edit to its TSV"
+        )
+        users_italic.unlink()
+        assert load_keymap('italic').apply('a') == '𝘢', (
+            "Cached keymap outlived the removal of its TSV"
+        )
+    finally:
+        util.KEYMAPS_DIR, util.CACHE_DIR = dirs
+
+# Deep nesting must not exhaust the stack
+
+deep = parse('%mono{' * 5000 + 'deep' + '}' * 5000)
+for __ in range(5001):
+    deep = deep.children[0][0]
+assert deep == 'deep', f"Deeply nested parse lost its content: {deep}"
+
+deep = expand('%smallcaps{' * 5000 + 'deep' + '}' * 5000)[0]
+assert deep == 'ᴅᴇᴇᴘ', f"Deeply nested expansion failed: {deep}"
+
+# Budgets must stop expansion, and must not change output within them
+
+def over_budget(text, context):
+    try:
+        expand(text, context)
+    except (DepthExceeded, OutputExceeded, TimeExceeded) as error:
+        return type(error)
+
+nested = '%smallcaps{' * 10 + 'deep' + '}' * 10
+assert over_budget(nested, {'target': 'txt', 'max_depth': 9}) is (
+    DepthExceeded
+), "Nesting past max_depth wasn't stopped"
+assert expand(nested, {'target': 'txt', 'max_depth': 10})[0] == 'ᴅᴇᴇᴘ'
+
+amplified = '%zalgo{' + 'hello ' * 50 + '}'
+assert over_budget(amplified, {'target': 'txt', 'max_ratio': 3}) is (
+    OutputExceeded
+), "Output past max_ratio wasn't stopped"
+assert over_budget(amplified, {'target': 'txt', 'max_output': 100}) is (
+    OutputExceeded
+), "Output past max_output wasn't stopped"
+assert over_budget(amplified, {'target': 'txt', 'time_limit': 0}) is (
+    TimeExceeded
+), "Expansion past time_limit wasn't stopped"
+titled = '%title{' + 'x' * 200 + '}' + ' hi' * 10
+assert expand(titled, {'target': 'txt', 'max_output': 100})[0] == ' hi' * 10, (
+    "Children an expander consumed were counted as output"
+)
+assert expand(writ, {'target': 'html', 'max_ratio': 2, 'time_limit': 60}) == (
+    expand(writ, {'target': 'html'})
+), "Budgets changed output"
+
+# Serialized trees must load back into trees that render the same
+
+for doc in [writ, repeated, nested, big]:
+    loaded = serial.loads(serial.dumps(compile(doc).tree))
+    assert Template(loaded).render({'target': 'html'}) == (
+        expand(doc, {'target': 'html'})
+    ), f"Serialized tree renders differently: {doc}"
+assert serial.key(writ) == serial.key(writ) != serial.key(repeated)
+data = serial.dumps(compile(writ).tree)
+corrupted = [data[:len(data) // 2], data[:-4], data + b'\0\0\0\0']
+
+# point the inner %em, the 2nd item, back at the root and at the outer %em
+nested_data = bytearray(serial.dumps(parse('%em{%em{x}}')))
+magic, version, block_size, *counts = serial.HEADER.unpack_from(nested_data)
+offset = serial.HEADER.size + block_size
+for name, size, count in zip(serial.SECTIONS, counts[::2], counts[1::2]):
+    if name == 'items':
+        break
+    offset += size * count
+string_count = counts[1]
+for node_ix in [0, 1]:
+    nested_data[offset + size] = string_count + node_ix
+    corrupted.append(bytes(nested_data))
+
+for corrupt in corrupted:
+    try:
+        serial.loads(corrupt)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Corrupt serialized tree was loaded")
+
 # Helpers
 
 ## strip
@@ -1 +1,8 @@
-from .expand import expand
+from .expand import (
+        compile, expand, expand_all, expand_iter, expand_to, profiling,
+        Profile, Template
+        )
+from .util import (
+        BudgetExceeded, DepthExceeded, Memo, OutputExceeded, TimeExceeded
+        )
+from .batch import expand_many, expand_many_iter
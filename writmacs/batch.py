@@ -0,0 +1,186 @@
+"""
+Expanding many documents at once, or one large document, across a pool of
+worker processes.
+"""
+
+from collections import deque
+from itertools import islice
+import os
+from typing import *
+
+from . import serial
+from .expand import eval_forest, expand, join_builder
+from .util import Node, OutputExceeded, get_keymap
+
+# keymaps used by the built-in macros, loaded by each worker as it starts
+WARM_KEYMAPS = ('italic', 'monospaced', 'rotated', 'small-caps')
+
+# estimated cost of evaluating one macro, in characters of source
+MACRO_COST = 64
+
+# batches per worker, so one slow batch doesn't leave the others idle
+BATCHES_PER_WORKER = 4
+
+
+def warm_up(keymap_names: Iterable[str] = WARM_KEYMAPS):
+    """Load keymaps ahead of time so the first documents don't wait."""
+    for name in keymap_names:
+        get_keymap(name)
+
+
+def _expand_chunk(docs, context):
+    return [expand(doc, context) for doc in docs]
+
+
+def expand_many_iter(
+        docs: Iterable[str],
+        context: dict = None,
+        workers: int = None,
+        chunksize: int = 64
+        ) -> Iterator[Tuple[str, dict]]:
+    """
+    Expand documents on a process pool, yielding (text, metadata) results
+    in input order.
+
+    Documents are read from the iterable only as workers need them, so no
+    more than a few chunks per worker are held in memory at once.
+    """
+    # imported here as it's costly and most processes never need it
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    docs = iter(docs)
+    in_flight = 2 * workers
+
+    pool = ProcessPoolExecutor(workers, initializer=warm_up)
+    try:
+        pending = deque()
+        while True:
+            while len(pending) < in_flight:
+                chunk = list(islice(docs, chunksize))
+                if len(chunk) == 0:
+                    break
+                pending.append(pool.submit(_expand_chunk, chunk, context))
+            if len(pending) == 0:
+                return
+            yield from pending.popleft().result()
+    finally:
+        # don't finish work nobody will read if iteration stops early
+        pool.shutdown(cancel_futures=True)
+
+
+def expand_many(
+        docs: Iterable[str],
+        context: dict = None,
+        workers: int = None,
+        chunksize: int = 64
+        ) -> List[Tuple[str, dict]]:
+    """
+    Expand documents on a process pool, returning (text, metadata) results
+    in input order.
+    """
+    return list(expand_many_iter(docs, context, workers, chunksize))
+
+
+def estimate_cost(item) -> int:
+    """
+    Estimate the cost of evaluating a forest item from its source length
+    and macro count.
+    """
+    if type(item) is not Node:
+        return len(item)
+    cost = 0
+    unvisited = [item]
+    while len(unvisited) > 0:
+        node = unvisited.pop()
+        cost += MACRO_COST
+        for forest in node.children:
+            for child in forest:
+                if type(child) is Node:
+                    unvisited.append(child)
+                else:
+                    cost += len(child)
+    return cost
+
+
+def partition(forest: Sequence, parts: int) -> List[list]:
+    """
+    Split a forest into contiguous batches of roughly equal estimated
+    cost.
+    """
+    estimates = [estimate_cost(item) for item in forest]
+    target = sum(estimates) / parts
+
+    batches = []
+    batch = []
+    batch_cost = 0
+    for item, cost in zip(forest, estimates):
+        batch.append(item)
+        batch_cost += cost
+        if batch_cost >= target:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def _eval_batch(data, context, budget):
+    forest, = serial.loads(data).children
+    builder, metadata = eval_forest(forest, context, budget)
+    return join_builder(builder), metadata
+
+
+def eval_parallel(
+        main_tree: Node,
+        context: dict,
+        workers: int = None,
+        budget: tuple = None
+        ) -> Tuple[List[str], dict]:
+    """
+    Evaluate the top-level subtrees of a semantic tree whose root does
+    nothing but join its children, in batches on a process pool.
+
+    Batches are contiguous and their results are merged in document order,
+    so later metadata still takes precedence over earlier. They are sent
+    to workers serialized flat, so even deeply nested ones can be pickled.
+
+    Each batch is held to the whole (max_output, deadline) budget as it is
+    evaluated, and the output size is checked again as batches are merged.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # the root's forests are simply concatenated, so they can be one
+    forest = [
+            item for root_forest in main_tree.children for item in root_forest
+            ]
+    batches = partition(forest, workers * BATCHES_PER_WORKER)
+
+    pool = ProcessPoolExecutor(workers, initializer=warm_up)
+    try:
+        results = [
+                pool.submit(
+                    _eval_batch,
+                    serial.dumps(Node('batch', [batch])), context, budget
+                    )
+                for batch in batches
+                ]
+        builder = []
+        metadata = {}
+        size = 0
+        for result in results:
+            chunk, batch_metadata = result.result()
+            size += len(chunk)
+            if budget is not None and budget[0] is not None and (
+                    size > budget[0]
+                    ):
+                raise OutputExceeded(f'Output passed {budget[0]} characters')
+            builder.append(chunk)
+            metadata.update(batch_metadata) # later > earlier
+        return builder, metadata
+    finally:
+        pool.shutdown(cancel_futures=True)
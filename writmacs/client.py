@@ -0,0 +1,59 @@
+"""
+A client for the expansion daemon in writmacs.server.
+
+This module only needs the standard library's socket, json and struct, so
+that asking a running daemon costs as little startup time as possible.
+"""
+
+import json
+import os
+import socket
+import struct
+
+# where the daemon listens, found without importing the rest of the package
+SOCKET_PATH = os.environ.get('WRITMACS_SOCKET', os.path.join(
+    os.path.expanduser('~'), '.config', 'writmacs', 'writmacs.sock'
+))
+HEADER = struct.Struct('>I')
+# seconds to wait on the daemon before giving up on it
+TIMEOUT = 30.0
+
+
+class ServerError(Exception):
+    """The daemon answered, but couldn't expand the text."""
+
+
+def encode_frame(message: dict) -> bytes:
+    payload = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(payload)) + payload
+
+
+def _receive(sock: socket.socket, length: int) -> bytes:
+    chunks = []
+    while length > 0:
+        chunk = sock.recv(length)
+        if chunk == b'':
+            raise ConnectionError('Daemon closed the connection')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b''.join(chunks)
+
+
+def request(
+        text: str, target: str = 'md', path=SOCKET_PATH, timeout=TIMEOUT
+        ):
+    """
+    Have a running daemon expand text, returning the text and metadata.
+
+    Raises OSError if no daemon is listening at path, or if it goes
+    timeout seconds without answering (socket.timeout is an OSError).
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(encode_frame({'text': text, 'target': target}))
+        length, = HEADER.unpack(_receive(sock, HEADER.size))
+        response = json.loads(_receive(sock, length))
+    if 'error' in response:
+        raise ServerError(response['error'])
+    return response['output'], response['metadata']
@@ -14,105 +14,590 @@
     and organized in a meaningful way
 '''
 
+from collections import ChainMap
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hashlib
 import sys
+import threading
+import time
 
 from .parse import parse
-from .macros import expanders, organizers, contextualizers
-from .util import TARGETS, Node
+from .macros import (
+        expanders, organizers, contextualizers, nondeterministic,
+        target_independent
+        )
+from .util import TARGETS, Node, OutputExceeded, Span, TimeExceeded
 
 DEFAULT_CONTEXT = {'target': 'md'}
 
+
+class Profile:
+    """
+    Where expansion time went: call count, cumulative seconds, and
+    characters of output per expander name, plus seconds per phase.
+    """
+
+    def __init__(self):
+        self.macros = {} # name -> [calls, seconds, chars out]
+        self.phases = {} # 'parse' or 'join' -> seconds
+        # one profile may be handed to blocks in several threads
+        self._lock = threading.Lock()
+
+    def add_macro(self, name, seconds, builder):
+        chars = sum([len(str(chunk)) for chunk in builder])
+        with self._lock:
+            stats = self.macros.setdefault(name, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += chars
+
+    def add_phase(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def report(self):
+        lines = [f'{"phase":<16}{"seconds":>12}']
+        for phase, seconds in self.phases.items():
+            lines.append(f'{phase:<16}{seconds:>12.6f}')
+        lines.append(f'{"macro":<16}{"seconds":>12}{"calls":>10}{"chars":>12}')
+        for name, (calls, seconds, chars) in sorted(
+                self.macros.items(), key=lambda item: -item[1][1]
+                ):
+            lines.append(f'{name:<16}{seconds:>12.6f}{calls:>10}{chars:>12}')
+        return '\n'.join(lines)
+
+
+# the Profile being recorded into, if any, per thread or task
+_profile = ContextVar('profile', default=None)
+
+
+@contextmanager
+def profiling(profile=None):
+    """
+    Record a Profile of every expansion run within the block, in this
+    thread or asyncio task only.
+
+    When not profiling, the only cost is checking whether to.
+    """
+    if profile is None:
+        profile = Profile()
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+
+
+def join_builder(builder):
+    """Join a builder into its final string."""
+    profile = _profile.get()
+    if profile is None:
+        return ''.join([str(chunk) for chunk in builder])
+    start = time.perf_counter()
+    joined = ''.join([str(chunk) for chunk in builder])
+    profile.add_phase('join', time.perf_counter() - start)
+    return joined
+
 def AST2tree(syntax_node):
-    name = syntax_node['name']
+    """
+    Turn an AST into a semantic tree by organizing, in place, the nodes
+    of macros that have organizers. The AST's Nodes are reused as they
+    are, so both trees are one and the same.
+    """
+    if len(organizers) == 0:
+        return syntax_node
 
-    if name in organizers:
-        protochildren, children_names = organizers[name](syntax_node)
-    else:
-        protochildren = syntax_node['vals']
-        children_names = {}
-
-    children = []
-    for section in protochildren:
-        forest = []
-        for chunk in section:
-            if type(chunk) is str:
-                forest.append(chunk)
-            else:
-                forest.append(AST2tree(chunk))
-        children.append(forest)
+    unvisited = [syntax_node]
+    while len(unvisited) > 0:
+        node = unvisited.pop()
+        if node.name in organizers:
+            # organizers are written for strings, not Spans
+            node.children = [solid(forest) for forest in node.children]
+            node.children, node.fields = organizers[node.name](node)
+        for forest in node.children:
+            unvisited.extend(item for item in forest if type(item) is Node)
+    return syntax_node
 
-    return Node(name, children, children_names)
 
+def semantic_tree(macs_txt, spans=False, max_depth=None):
 
-def semantic_tree(macs_txt):
+    profile = _profile.get()
+    if profile is None:
+        return AST2tree(parse(macs_txt, spans, max_depth))
+    start = time.perf_counter()
+    AST = parse(macs_txt, spans, max_depth)
+    main_tree = AST2tree(AST)
+    profile.add_phase('parse', time.perf_counter() - start)
+    return main_tree
 
-    AST = parse(macs_txt)
-    return AST2tree(AST)
 
+def resolve(name):
+    """Look up the contextualizer and expander for a macro name."""
+    return contextualizers.get(name), expanders.get(name)
 
-def eval_forest(forest, context=None):
 
-    if context is None:
-        context = {}
+def fingerprint(mac_tree):
+    """
+    Give every node of a semantic tree a digest of its subtree's
+    structure and content, noting whether nondeterministic macros are
+    used anywhere within it.
+    """
+    nodes = [] # parents before children
+    unvisited = [mac_tree]
+    while len(unvisited) > 0:
+        node = unvisited.pop()
+        if node.fingerprint is not None:
+            continue
+        nodes.append(node)
+        for forest in node.children:
+            unvisited.extend(item for item in forest if type(item) is Node)
 
+    for node in reversed(nodes):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr(
+            (node.name, sorted(node.fields.items()))
+        ).encode('utf-8', 'surrogatepass'))
+        volatile = node.name in nondeterministic
+        for forest in node.children:
+            digest.update(b'[')
+            for item in forest:
+                if type(item) is Node:
+                    child_digest, child_volatile = item.fingerprint
+                    digest.update(b'n' + child_digest)
+                    volatile = volatile or child_volatile
+                else:
+                    content = str(item).encode('utf-8', 'surrogatepass')
+                    digest.update(b's%d:' % len(content))
+                    digest.update(content)
+            digest.update(b']')
+        node.fingerprint = (digest.digest(), volatile)
+
+
+def solid(builder):
+    """Turn any Spans in a builder into strings."""
+    return [str(chunk) if type(chunk) is Span else chunk for chunk in builder]
+
+
+def merge_metadata(updates):
+    """Merge metadata dicts in order, later > earlier."""
     data_out = {}
-    builder = []
+    for update in updates:
+        data_out.update(update)
+    return data_out
+
 
-    for item in forest:
-        if type(item) is Node:
-            chunks, tree_data_out = eval_tree(item, context)
-            builder.extend(chunks)
-            data_out = {**data_out, **tree_data_out} # later > earlier
+def budget_for(context, source_length=None):
+    """
+    Work out the output size and deadline a context's max_output,
+    max_ratio (of output to source length) and time_limit (in seconds)
+    allow, as a (max_output, deadline) budget, or None if unlimited.
+    """
+    max_output = context.get('max_output')
+    max_ratio = context.get('max_ratio')
+    if max_ratio is not None and source_length is not None:
+        ratio_output = int(max_ratio * source_length)
+        if max_output is None or ratio_output < max_output:
+            max_output = ratio_output
+    time_limit = context.get('time_limit')
+    deadline = None
+    if time_limit is not None:
+        deadline = time.monotonic() + time_limit
+    if max_output is None and deadline is None:
+        return None
+    return max_output, deadline
+
+
+def measure(builder):
+    """Count the characters a builder will join into."""
+    return sum([
+        len(chunk) if type(chunk) is str or type(chunk) is Span
+        else len(str(chunk))
+        for chunk in builder
+    ])
+
+
+# names the root of an eval_forest call, which has no macro of its own
+_FOREST = object()
+
+
+def _evaluate(mac_tree, context, shared=None, memo=None, budget=None):
+    """
+    Evaluate a semantic tree in post-order using an explicit stack.
+
+    Every open node shares one output stack: a node's children are built
+    on top of it and sliced off once the node is ready to expand, so no
+    per-node working lists are needed beyond what expanders receive.
+
+    Spans of the source are only turned into strings once they reach a
+    node with an expander; those passing straight through to the output
+    stay as they are.
+
+    Metadata is likewise logged in one list, in the post-order the nodes
+    finish, and merged once at the end; each node's own metadata lands
+    after its descendants' and later siblings' after earlier ones'.
+
+    Results of nodes whose ids are keys of `shared` are stored there when
+    first evaluated and reused from then on. Given a Memo, results are
+    also stored and reused by fingerprint and context.
+
+    Given a (max_output, deadline) budget, the output is measured as it is
+    emitted and OutputExceeded or TimeExceeded is raised as soon as it goes
+    over. Children of a node with an expander aren't output until the
+    expander has turned them into its own, so only what it gives back is
+    counted, whatever it does with them.
+    """
+    out = []
+    metadata = []
+    # node, its expander, context given, context for children, forest
+    # index, item index, output stack offsets where each forest starts,
+    # metadata log offset, memo key, whether output passes through as is
+    frames = []
+    profile = _profile.get()
+
+    # each context seen, kept alive alongside its key so that its id
+    # can't be reused by a later context while evaluating
+    context_keys = {}
+
+    if budget is not None:
+        max_output, deadline = budget
+        out_size = 0
+
+    def grow(size):
+        nonlocal out_size
+        out_size += size
+        if max_output is not None and out_size > max_output:
+            raise OutputExceeded(f'Output passed {max_output} characters')
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeExceeded('Ran past the time limit')
+
+    def memo_key(node, context):
+        digest, volatile = node.fingerprint
+        if volatile and context.get('seed') is None:
+            return None
+        seen = context_keys.get(id(context))
+        if seen is None or seen[0] is not context:
+            try:
+                context_key = tuple(sorted(context.items()))
+                hash(context_key)
+            except TypeError:
+                context_key = None # can't tell contexts apart, don't cache
+            seen = context_keys[id(context)] = (context, context_key)
+        if seen[1] is None:
+            return None
+        return digest, seen[1]
+
+    if memo is not None:
+        fingerprint(mac_tree)
+        key = memo_key(mac_tree, context)
+        cached = key and memo.get(key)
+        if cached:
+            if budget is not None:
+                grow(measure(cached[0]))
+            return list(cached[0]), merge_metadata(cached[1])
+    else:
+        key = None
+
+    def open_frame(node, context, key, raw):
+        contextualizer, expander = node.resolved or resolve(node.name)
+        if contextualizer is not None:
+            # deeper > shallower
+            local_context = ChainMap(contextualizer(
+                [solid(forest) for forest in node.children]
+            ), context)
         else:
-            # a str or something that can be cast to one e.g. a Token
-            builder.append(item)
+            local_context = context
+        frames.append([
+            node, expander, context, local_context, 0, 0, [len(out)],
+            len(metadata), key, raw and expander is None
+        ])
 
-    return builder, data_out
+    open_frame(mac_tree, context, key, True)
+    while True:
+        frame = frames[-1]
+        node, __, __, local_context, forest_ix, item_ix, starts = frame[:7]
+        children = node.children
 
+        # push strings until reaching a node or the end of a forest
+        if forest_ix < len(children):
+            forest = children[forest_ix]
+            while item_ix < len(forest):
+                item = forest[item_ix]
+                item_ix += 1
+                if type(item) is Node:
+                    if shared is not None and shared.get(id(item)):
+                        builder, data = shared[id(item)]
+                        if budget is not None:
+                            grow(measure(builder) if frame[9] else 0)
+                        out.extend(builder)
+                        metadata.extend(data)
+                        continue
+                    key = None
+                    if memo is not None:
+                        key = memo_key(item, local_context)
+                        cached = key and memo.get(key)
+                        if cached:
+                            if budget is not None:
+                                grow(measure(cached[0]) if frame[9] else 0)
+                            out.extend(cached[0])
+                            metadata.extend(cached[1])
+                            continue
+                    frame[5] = item_ix
+                    open_frame(item, local_context, key, frame[9])
+                    break
+                # a str or something that can be cast to one e.g. a Token
+                if type(item) is Span and not frame[9]:
+                    item = str(item)
+                if budget is not None:
+                    grow(measure([item]) if frame[9] else 0)
+                out.append(item)
+            else:
+                frame[4] = forest_ix + 1
+                frame[5] = 0
+                starts.append(len(out))
+            continue
 
-def eval_tree(mac_tree, context=None):
+        # all forests are built, so perform the macro operation
+        frames.pop()
+        node, expander, context, __, __, __, starts, meta_start, key, __ = (
+                frame
+                )
+        if expander is not None:
+            builders = [
+                    out[starts[ix]:starts[ix + 1]]
+                    for ix in range(len(starts) - 1)
+                    ]
+            del out[starts[0]:]
+            if profile is None:
+                builder_out, *more_data = expander(builders, context)
+            else:
+                start = time.perf_counter()
+                builder_out, *more_data = expander(builders, context)
+                profile.add_macro(
+                        node.name, time.perf_counter() - start, builder_out
+                        )
+            # only counted once nothing above it can throw it away
+            if budget is not None:
+                grow(
+                    measure(builder_out)
+                    if len(frames) == 0 or frames[-1][9] else 0
+                )
+            out.extend(builder_out)
+            if len(more_data) == 1:
+                metadata.append(more_data[0])
+        # if no operation to do, default to flattening children together
+        # which is exactly how they already sit on the output stack
+
+        # stored results may be reused where spans aren't welcome
+        if shared is not None and id(node) in shared:
+            shared[id(node)] = (solid(out[starts[0]:]), metadata[meta_start:])
+        if key is not None:
+            memo.put(key, (solid(out[starts[0]:]), metadata[meta_start:]))
+
+        if len(frames) == 0:
+            return out, merge_metadata(metadata)
+
+
+def eval_forest(forest, context=None, budget=None):
 
     if context is None:
         context = {}
 
-    # create context specifically for this sub-tree
-    if mac_tree.name in contextualizers:
-        # deeper > shallower
-        local_context = {
-            **context,
-            **contextualizers[mac_tree.name](mac_tree.children)
-        }
-    else:
-        local_context = context
+    return _evaluate(Node(_FOREST, [forest]), context, budget=budget)
 
-    # evaluate the sub-tree below
-    children = []
-    data_out = {}
-    for forest in mac_tree.children:
-        builder, child_data_out = eval_forest(forest, local_context)
-        children.append(builder)
-        data_out.update(child_data_out)
-
-    # perform the macro operation for this tree node
-    if mac_tree.name in expanders:
-        builder_out, *more_data = expanders[mac_tree.name](
-                children, context
+
+def eval_tree(mac_tree, context=None, memo=None, budget=None):
+
+    if context is None:
+        context = {}
+
+    return _evaluate(mac_tree, context, memo=memo, budget=budget)
+
+
+def expand(main_txt, context=None, memo=None, workers=None):
+    """
+    Expand macro text, returning the output and the document's metadata.
+
+    Given a number of workers, the document's top-level subtrees are
+    evaluated in batches on that many processes, which only pays off for
+    very large documents. The memo is not used in that case.
+
+    The context may set budgets: max_depth of nesting, max_output
+    characters, max_ratio of output to source length and a time_limit in
+    seconds. Going over any of them raises a BudgetExceeded.
+    """
+    if context is None:
+        context = DEFAULT_CONTEXT
+    budget = budget_for(context, len(main_txt))
+    main_tree = semantic_tree(
+            main_txt, spans=True, max_depth=context.get('max_depth')
+            )
+    if workers is not None and workers > 1 and not (
+            main_tree.name in expanders or main_tree.name in contextualizers
+            ):
+        # imported here as batch itself imports this module
+        from .batch import eval_parallel
+        full_builder, full_meta = eval_parallel(
+                main_tree, context, workers, budget
                 )
-        if len(more_data) == 1:
-            data_out.update(more_data[0])
     else:
-        # if no operation to do, default to flattening children together
-        builder_out = [chunk for child in children for chunk in child]
+        full_builder, full_meta = eval_tree(main_tree, context, memo, budget)
+    return join_builder(full_builder), full_meta
+
+
+class Template:
+    """
+    Macro text parsed and organized once, ready to be rendered any number
+    of times with different contexts.
+
+    Each node's macro functions are looked up when compiling, so later
+    changes to the expanders or contextualizers tables are not seen.
+    """
 
-    return builder_out, data_out
+    def __init__(self, main_tree, source_length=None):
+        self._tree = main_tree
+        self._source_length = source_length
 
+    @property
+    def tree(self):
+        return self._tree
 
-def expand(main_txt, context=None):
+    def render(self, context=None, memo=None):
+        """Evaluate the template, returning its text and metadata."""
+        if context is None:
+            context = DEFAULT_CONTEXT
+        budget = budget_for(context, self._source_length)
+        full_builder, full_meta = eval_tree(self._tree, context, memo, budget)
+        return join_builder(full_builder), full_meta
+
+
+def compile(main_txt, max_depth=None):
+    """Parse and organize macro text into a reusable Template."""
+    main_tree = semantic_tree(main_txt, max_depth=max_depth)
+    nodes = [main_tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        node.resolved = resolve(node.name)
+        for forest in node.children:
+            nodes.extend(item for item in forest if type(item) is Node)
+    return Template(main_tree, len(main_txt))
+
+
+def _target_independent_nodes(main_tree):
+    """
+    Find the nodes of a semantic tree whose whole subtree evaluates the
+    same regardless of target, as a dict keyed by node id.
+    """
+    nodes = [] # parents before children
+    unvisited = [main_tree]
+    while len(unvisited) > 0:
+        node = unvisited.pop()
+        nodes.append(node)
+        for forest in node.children:
+            unvisited.extend(item for item in forest if type(item) is Node)
+
+    independent = {}
+    for node in reversed(nodes):
+        contextualizer, __ = node.resolved or resolve(node.name)
+        if (
+                node.name in target_independent
+                and contextualizer is None
+                and all(
+                    id(item) in independent
+                    for forest in node.children
+                    for item in forest
+                    if type(item) is Node
+                )):
+            independent[id(node)] = None
+    return independent
+
+
+def expand_all(main_txt, targets=('html', 'md', 'txt'), context=None):
+    """
+    Expand macro text into several targets at once.
+
+    The text is parsed and organized only once, and subtrees whose output
+    doesn't depend on the target are evaluated once and shared. Returns a
+    dict of (text, metadata) results keyed by target.
+    """
     if context is None:
         context = DEFAULT_CONTEXT
-    main_tree = semantic_tree(main_txt)
-    full_builder, full_meta = eval_tree(main_tree, context)
-    return ''.join([str(chunk) for chunk in full_builder]), full_meta
+    budget = budget_for(context, len(main_txt))
+    main_tree = semantic_tree(main_txt, max_depth=context.get('max_depth'))
+    shared = _target_independent_nodes(main_tree)
+
+    results = {}
+    for target in targets:
+        full_builder, full_meta = _evaluate(
+                main_tree, {**context, 'target': target}, shared,
+                budget=budget
+                )
+        results[target] = (
+                join_builder(full_builder), full_meta
+                )
+    return results
+
+
+def expand_iter(main_txt, context=None):
+    """
+    Expand macro text, yielding output strings as soon as each top-level
+    node of the document is evaluated.
+
+    The document's metadata is the generator's return value, delivered
+    once every chunk has been yielded.
+    """
+    if context is None:
+        context = DEFAULT_CONTEXT
+    budget = budget_for(context, len(main_txt))
+    main_tree = semantic_tree(
+            main_txt, spans=True, max_depth=context.get('max_depth')
+            )
+
+    if main_tree.name in expanders or main_tree.name in contextualizers:
+        # the root itself transforms its children, so nothing is final early
+        full_builder, full_meta = eval_tree(main_tree, context, budget=budget)
+        yield join_builder(full_builder)
+        return full_meta
+
+    full_meta = {}
+    emitted = 0
+    for forest in main_tree.children:
+        for item in forest:
+            item_budget = None
+            if budget is not None:
+                # what earlier chunks used is no longer available
+                max_output, deadline = budget
+                if max_output is not None:
+                    max_output -= emitted
+                item_budget = max_output, deadline
+            if type(item) is Node:
+                builder, tree_meta = eval_tree(
+                        item, context, budget=item_budget
+                        )
+                full_meta.update(tree_meta) # later > earlier
+                chunk = join_builder(builder)
+            elif item_budget is not None:
+                builder, __ = eval_forest([item], context, item_budget)
+                chunk = join_builder(builder)
+            else:
+                chunk = join_builder([item])
+            emitted += len(chunk)
+            if chunk != '':
+                yield chunk
+    return full_meta
+
+
+def expand_to(stream, main_txt, context=None):
+    """
+    Expand macro text, writing output to a file-like stream as it is
+    produced, and return the document's metadata.
+    """
+    chunks = expand_iter(main_txt, context)
+    while True:
+        try:
+            stream.write(next(chunks))
+        except StopIteration as done:
+            return done.value
 
 if __name__ == '__main__':
     mac_txt = sys.stdin.read()
@@ -1,6 +1,46 @@
-from random import random, randint
+from operator import getitem
+import random
 from .util import *
 
+# combining diacritical marks, U+0300 through U+0362
+DIACRITICS = [chr(code) for code in range(768, 867)]
+ZALGO_MARKS = 8 # per character
+COIN = (True, False)
+STUDLY_ODDS = (0.4, 1.0) # cumulative: capital 40% of the time
+
+# I is always lowercase and L always capital, to avoid confusion
+STUDLY_FIXED = {'I': 'i', 'i': 'i', 'L': 'L', 'l': 'L'}
+STUDLY_LOWER = str.maketrans(
+        {**{letter: letter.lower() for letter in LETTERS}, **STUDLY_FIXED}
+        )
+STUDLY_UPPER = str.maketrans(
+        {**{letter: letter.upper() for letter in LETTERS}, **STUDLY_FIXED}
+        )
+
+UNDERLINABLE = set(
+        '0123456789ABCDEFGHIJKLMNOPRSTUVWXYZabcdefhiklmnorstuvwxz'
+        + 'ĉĈĥĤŭŬêÊĴĜ().?!:-\'"+=*&^%$#@`~'
+        )
+# UNDERLINE = chr(int('952', 16))
+# UNDERLINE = chr(int('331', 16))
+UNDERLINE = chr(int('320', 16))
+UNDERLINE_TABLE = str.maketrans({
+        ' ': '_',
+        **{character: character + UNDERLINE for character in UNDERLINABLE}
+        })
+
+_random = random.Random()
+
+def random_source(context) -> random.Random:
+    """
+    Get a random number generator for one macro call, seeded from
+    context['seed'] so results repeat, or else unseeded.
+    """
+    seed = context.get('seed')
+    if seed is None:
+        return _random
+    return random.Random(seed)
+
 """
 Emphasize text.
 
@@ -58,10 +98,14 @@ def rotated(fields, context):
     Unicode characters are used in all cases because there's no HTML
     support for this.
     """
-    content = fields[0]
-    flipped, data_out = keymapper('rotated')(fields, context)
-    rev_content = list(reversed(flipped))
-    return rev_content, data_out
+    keymap = get_keymap('rotated')
+    rev_content = []
+    for chunk in reversed(fields[0]):
+        if type(chunk) is str:
+            rev_content.append(keymap.apply_reversed(chunk))
+        else:
+            rev_content.append(chunk)
+    return rev_content, {}
 
 def section(fields, context):
     """
@@ -96,17 +140,11 @@ def snippet(fields, context):
     """
     Insert a snippet by name.
     """
-    snip_name = ''.join(fields[0])
-    if snip_name not in SNIPPET_CACHE:
+    snip_name = ''.join([str(chunk) for chunk in fields[0]])
+    text = SNIPPET_STORE.get(snip_name, context['target'])
+    if text is None:
         return [snip_name], {}
-    elif context['target'] == 'md': # working with markdown, need escapes
-        snippet = (SNIPPET_CACHE[snip_name]
-                .replace('\\', r'\\')
-                .replace('_', r'\_')
-                .replace('*', r'\*'))
-        return snippet, {}
-    else:
-        return SNIPPET_CACHE[snip_name], {}
+    return [text], {}
 
 def title(fields, __):
     """
@@ -116,30 +154,24 @@ def title(fields, __):
     """
     return [], {'title': fields[0]}
 
-def studly(fields, __):
+def studly(fields, context):
     """
     Render letters as either capital or lowercase almost at random.
 
     The letter I is always lowercase and L is always capital, to avoid
     confusion.
     """
+    rng = random_source(context)
     def studly_str(text) -> str:
         if not type(text) is str:
             return text
-        builder = []
-        for character in text:
-            if character in 'Ii':
-                builder.append('i')
-            elif character in 'Ll':
-                builder.append('L')
-            elif character in LETTERS:
-                if random() < 0.4:
-                    builder.append(character.upper())
-                else:
-                    builder.append(character.lower())
-            else:
-                builder.append(character)
-        return ''.join(builder)
+        # one draw per character, letter or not, so that a seed decides
+        # each position regardless of what's there
+        capitals = rng.choices(COIN, cum_weights=STUDLY_ODDS, k=len(text))
+        cases = zip(
+                text.translate(STUDLY_LOWER), text.translate(STUDLY_UPPER)
+                )
+        return ''.join(map(getitem, cases, capitals))
     return [studly_str(chunk) for chunk in fields[0]], {}
 
 def underlined(fields, context):
@@ -152,30 +184,14 @@ def underlined(fields, context):
     content = fields[0]
     target = context['target']
     if target == 'html':
-        return taggifier('span', Class='underlined')(content, {})
-    UNDERLINABLE = set(
-            '0123456789ABCDEFGHIJKLMNOPRSTUVWXYZabcdefhiklmnorstuvwxz'
-            + 'ĉĈĥĤŭŬêÊĴĜ().?!:-\'"+=*&^%$#@`~'
-            )
-    # UNDERLINE = chr(int('952', 16))
-    # UNDERLINE = chr(int('331', 16))
-    UNDERLINE = chr(int('320', 16))
-    def underline_str(text) -> Union[str, Token]:
-        if not type(text) is str:
-            return text
-        builder = []
-        for character in text:
-            if character == ' ':
-                builder.append('_')
-            else:
-                builder.append(character)
-                if character in UNDERLINABLE:
-                    builder.append(UNDERLINE)
-        return ''.join(builder)
+        return taggifier('span', Class='underlined')([content], {})
 
     builder = []
     for chunk in content:
-        builder.append(underline_str(chunk))
+        if type(chunk) is str:
+            builder.append(chunk.translate(UNDERLINE_TABLE))
+        else:
+            builder.append(chunk)
     return builder, {}
 
 
@@ -184,21 +200,31 @@ Wrap text in sparkle emoticons.
 """
 sparkly = wrapper('✧⭒͙°', '✧ﾟ☆')
 
-def zalgo(fields, __):
+def zalgo(fields, context):
     """
     Apply many random diacritics to text.
     """
+    rng = random_source(context)
     builder = []
     for chunk in fields[0]:
         if type(chunk) is str:
-            for character in chunk:
-                builder.append(character)
-                builder.extend([chr(randint(768, 866)) for n in range(8)])
+            marks = rng.choices(DIACRITICS, k=ZALGO_MARKS * len(chunk))
+            # interleave each character with its marks
+            step = ZALGO_MARKS + 1
+            pieces = [''] * (step * len(chunk))
+            pieces[::step] = chunk
+            for offset in range(ZALGO_MARKS):
+                pieces[offset + 1::step] = marks[offset::ZALGO_MARKS]
+            builder.append(''.join(pieces))
         else:
             builder.append(chunk)
     return builder, {}
 
-keymaps = [path.stem for path in KEYMAPS_DIR.iterdir() if path.stem == '.tsv']
+keymaps = [
+        path.stem for path in
+        (KEYMAPS_DIR.iterdir() if KEYMAPS_DIR.is_dir() else [])
+        if path.stem == '.tsv'
+        ]
 
 expanders: Dict[str, Macro] = {
         # unless overwritten, all keymaps may be invoked by name
@@ -224,8 +250,8 @@ expanders: Dict[str, Macro] = {
         'smallcaps': small_caps,
         'small-caps': small_caps,
 
-        # 'snip': snippet,
-        # 'snippet': snippet,
+        'snip': snippet,
+        'snippet': snippet,
 
         'sparkly': sparkly,
         'sparkle': sparkly,
@@ -241,5 +267,17 @@ expanders: Dict[str, Macro] = {
         'void': zalgo,
         'zalgo': zalgo,
         }
+# macros whose output never depends on context['target']
+target_independent: Set[str] = {
+        'map', 'keymap',
+        'rot', 'rotate', 'rotated',
+        'sparkly', 'sparkle',
+        'title',
+        }
+# macros whose output differs between runs unless context['seed'] is set
+nondeterministic: Set[str] = {
+        'studly',
+        'void', 'zalgo',
+        }
 organizers: Dict[str, Callable] = {}
 contextualizers: Dict[str, Callable] = {}
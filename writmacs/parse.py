@@ -1,4 +1,6 @@
-from .util import strip_seq
+import re
+
+from .util import DepthExceeded, Node, Span, strip_seq
 
 INTERPOLATE = '%'
 TERMINATE = ';'
@@ -14,100 +16,131 @@ BRACKETS = {
 AMBIBRACKETS = set('()[]{}<>"`\'/')
 WHITESPACE = set(' \n\t')
 
+# a macro name runs until a bracket, whitespace, or terminator
+NAME_PATTERN = re.compile(
+        '[^' + re.escape(''.join(sorted(AMBIBRACKETS | WHITESPACE))
+        + TERMINATE) + ']*'
+        )
+
 def tree_print(chunks, depth=0):
     for chunk in chunks:
-        if type(chunk) == dict:
-            print('  ' * depth + '%' + chunk['name'])
-            for i in range(len(chunk['vals'])):
-                print('  ' * depth + ' ' + chunk['bracs'][i])
-                tree_print(chunk['vals'][i], depth=depth+1)
+        if type(chunk) is Node:
+            print('  ' * depth + '%' + chunk.name)
+            for i in range(len(chunk.children)):
+                print('  ' * depth + ' ' + chunk.bracs[i])
+                tree_print(chunk.children[i], depth=depth+1)
         else:
-            print('  ' * depth + chunk)
+            print('  ' * depth + str(chunk))
 
 
-def parse(text):
-    breadcrumbs = []
-    frontier = 0
+def parse(text, spans=False, max_depth=None):
+    """
+    Parse macro text into an AST of nested Nodes, each holding the values
+    given to a macro as its children and the brackets used as its bracs.
 
-    def at_ladder():
-        if len(breadcrumbs) == 0:
-            return False
+    With spans, runs of text are left in place as Spans of the source
+    instead of being copied out as strings.
 
-        ladder = breadcrumbs[-1]
-        if frontier + len(ladder) > len(text):
-            return False
-
-        return text[frontier:frontier + len(ladder)] == ladder
-
-    def parse_prose():
-        nonlocal frontier
-        start = frontier
-        chunks = []
+    Given a max_depth, DepthExceeded is raised as soon as a macro opens
+    nested any deeper.
 
-        while True:
-            while (
-                    frontier < len(text)
-                    and not at_ladder()
-                    and text[frontier] != INTERPOLATE
-                    ):
-                frontier += 1
+    Nesting is tracked with an explicit stack rather than recursion, so
+    arbitrarily deep documents parse in constant Python stack space.
+    """
+    breadcrumbs = []
+    frontier = 0
 
-            if frontier > start:
-                chunks.append(text[start:frontier])
-                start = frontier
+    # next known position of each needle, so repeated searches for the same
+    # ladder don't rescan text already known to be free of it
+    found = {}
+
+    def find(needle):
+        position = found.get(needle)
+        if position is None or position < frontier:
+            position = text.find(needle, frontier)
+            if position == -1:
+                position = len(text)
+            found[needle] = position
+        return position
+
+    root = Node('root', [])
+    # each open macro is paired with the prose chunks of its parent
+    macros = [(root, None)]
+    chunks = []
+    start = frontier
+
+    while True:
+        # scan prose until it closes or a macro begins
+        stop = find(INTERPOLATE)
+        if len(breadcrumbs) > 0:
+            ladder = breadcrumbs[-1]
+            ladder_at = find(ladder)
+            if ladder_at <= stop:
+                stop = ladder_at
+        else:
+            ladder = None
+        frontier = stop
 
-            if frontier == len(text):
-                return strip_seq(chunks)
+        if frontier > start:
+            chunks.append(
+                    Span(text, start, frontier) if spans
+                    else text[start:frontier]
+                    )
 
-            if at_ladder():
-                frontier += len(breadcrumbs[-1])
-                breadcrumbs.pop()
-                return strip_seq(chunks)
-
-            if text[frontier] == INTERPOLATE:
-                chunks.append(parse_macro())
-                start = frontier
-
-    def parse_macro():
-        nonlocal frontier
-        name_start = frontier + 1 # skip INTERPOLATE character
-        frontier = name_start
-
-        while (
-                frontier < len(text)
-                and text[frontier] not in AMBIBRACKETS
-                and text[frontier] not in WHITESPACE
-                and text[frontier] != TERMINATE
+        if frontier < len(text) and not (
+                ladder is not None and text.startswith(ladder, frontier)
                 ):
-            frontier += 1
-
-        name = text[name_start:frontier]
-        vals = []
-        bracs = []
+            # text[frontier] == INTERPOLATE, so open a new macro
+            if max_depth is not None and len(macros) > max_depth:
+                raise DepthExceeded(f'Macros nested deeper than {max_depth}')
+            name_start = frontier + 1 # skip INTERPOLATE character
+            frontier = NAME_PATTERN.match(text, name_start).end()
+            macro = Node(text[name_start:frontier], [], bracs=[])
+            macros.append((macro, chunks))
+        else:
+            # prose is over, hand it to the macro it belongs to
+            if frontier < len(text):
+                frontier += len(ladder)
+                breadcrumbs.pop()
+            macro, parent_chunks = macros[-1]
+            macro.children.append(strip_seq(chunks))
+            if parent_chunks is None:
+                return root
 
+        # open the macro's next bracketed value, or finish the macro
+        macro, parent_chunks = macros[-1]
         while frontier < len(text) and text[frontier] in BRACKETS:
             bracket_start = frontier
-            while text[frontier] == text[bracket_start]:
+            while (
+                    frontier < len(text)
+                    and text[frontier] == text[bracket_start]
+                    ):
                 frontier += 1
             bracket = text[bracket_start:frontier]
-            bracs.append(bracket)
+            macro.bracs.append(bracket)
 
             # reverse bracket direction for close bracket string a.k.a. ladder
             breadcrumbs.append(BRACKETS[bracket[0]] * len(bracket))
 
-            if bracket.startswith('`'): # literal quotation
-                prose_start = frontier
-                while frontier < len(text) and not at_ladder():
-                    frontier += 1
-                vals.append([text[prose_start:frontier]])
-                frontier += len(bracket) # jump over closing bracket
-            else:
-                vals.append(parse_prose())
-
-        # print('PARSED PROSE, NOW AT:', frontier)
-        if frontier < len(text) and text[frontier] == ';':
-            frontier += 1
-
-        return {'name': name, 'bracs': bracs, 'vals': vals}
+            if not bracket.startswith('`'):
+                break
+
+            # literal quotation
+            prose_start = frontier
+            frontier = find(breadcrumbs[-1])
+            macro.children.append([
+                Span(text, prose_start, frontier) if spans
+                else text[prose_start:frontier]
+                ])
+            frontier += len(bracket) # jump over closing bracket
+        else:
+            if frontier < len(text) and text[frontier] == TERMINATE:
+                frontier += 1
+            macros.pop()
+            parent_chunks.append(macro)
+            chunks = parent_chunks
+            start = frontier
+            continue
 
-    return {'name': 'root', 'vals': [parse_prose()]}
+        chunks = []
+        start = frontier
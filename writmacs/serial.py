@@ -0,0 +1,271 @@
+"""
+A compact, versioned binary format for semantic trees, so documents that
+are rendered over and over needn't be parsed and organized every time.
+
+A serialized tree is a header, a string table and a node table, all
+little-endian:
+
+    header       MAGIC, uint16 FORMAT_VERSION, uint32 size of the UTF-8
+                 block, then the item size and length of each of SECTIONS
+    UTF-8 block  every string of the string table one after another
+    SECTIONS     arrays of unsigned integers, each as narrow as its
+                 largest value allows:
+      lengths        length in characters of each string
+      names          each node's name, with nodes in pre-order
+      brac_counts    number of bracs of each node
+      forest_counts  number of forests of each node
+      item_counts    number of items of each forest, in node order
+      bracs          every node's bracs, in node order
+      items          every forest's items, in forest order
+      fields         (node, field name, forest index) for each field
+
+Names, field names and bracs are indices into the string table. Items
+index the string table followed by the nodes, so a string item is its
+string's index and a node item is the number of strings plus its node's
+index. Spans are stored as the text they cover.
+
+Keeping like values together lets loading build nodes with a few bulk
+operations rather than decoding each one in turn. On a macro-dense 930k
+character document, loads takes about 0.35 times as long as parsing, and
+the data is about the size of the source in UTF-8. Documents of plain
+prose gain nothing, as they parse about as fast as they can be read.
+"""
+
+from array import array
+from hashlib import sha256
+from itertools import accumulate, chain, compress, islice, repeat
+from operator import le
+import struct
+import sys
+from typing import *
+
+from .util import Node, Span
+
+MAGIC = b'WMST'
+# bump whenever the layout below changes
+FORMAT_VERSION = 2
+SECTIONS = (
+    'lengths', 'names', 'brac_counts', 'forest_counts', 'item_counts',
+    'bracs', 'items', 'fields'
+)
+HEADER = struct.Struct('<4sHI' + 'BI' * len(SECTIONS))
+# array typecodes by item size, preferring the narrowest for each
+TYPECODES = {array(code).itemsize: code for code in 'QLIHB'}
+
+
+def key(text: str) -> str:
+    """
+    Give a content hash of macro text, fit for naming its serialized tree
+    in a cache. Trees stored in an older format get different keys.
+    """
+    digest = sha256(MAGIC + FORMAT_VERSION.to_bytes(2, 'little'))
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _pack(numbers: list) -> Tuple[int, bytes]:
+    """Pack unsigned integers as narrowly as they fit, little-endian."""
+    largest = max(numbers, default=0)
+    size = next(
+        size for size in sorted(TYPECODES) if largest < 1 << (8 * size)
+    )
+    packed = array(TYPECODES[size], numbers)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return size, packed.tobytes()
+
+
+def _unpack(data: bytes, size: int) -> list:
+    if size not in TYPECODES:
+        raise ValueError('Serialized semantic tree is corrupt')
+    unpacked = array(TYPECODES[size])
+    unpacked.frombytes(data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+def dumps(main_tree: Node) -> bytes:
+    """Serialize a semantic tree into bytes."""
+    strings = []
+    string_ixs = {}
+
+    def intern(string):
+        ix = string_ixs.get(string)
+        if ix is None:
+            ix = string_ixs[string] = len(strings)
+            strings.append(string)
+        return ix
+
+    # number the nodes in pre-order before writing any, so items can
+    # refer to nodes that come after them
+    nodes = []
+    node_ixs = {}
+    unvisited = [main_tree]
+    while len(unvisited) > 0:
+        node = unvisited.pop()
+        node_ixs[id(node)] = len(nodes)
+        nodes.append(node)
+        unvisited.extend(reversed([
+            item
+            for forest in node.children
+            for item in forest
+            if type(item) is Node
+        ]))
+
+    sections = {name: [] for name in SECTIONS}
+    items = sections['items']
+    # strings are interned as they're met, so node items are offset later
+    node_items = []
+    for node_ix, node in enumerate(nodes):
+        sections['names'].append(intern(node.name))
+        for field_name, forest_ix in node.fields.items():
+            sections['fields'].extend(
+                (node_ix, intern(field_name), forest_ix)
+            )
+        sections['brac_counts'].append(len(node.bracs))
+        sections['bracs'].extend(intern(brac) for brac in node.bracs)
+        sections['forest_counts'].append(len(node.children))
+        for forest in node.children:
+            sections['item_counts'].append(len(forest))
+            for item in forest:
+                if type(item) is Node:
+                    node_items.append(len(items))
+                    items.append(node_ixs[id(item)])
+                elif type(item) is str or type(item) is Span:
+                    items.append(intern(str(item)))
+                else:
+                    raise TypeError(f'Cannot serialize forest item: {item!r}')
+
+    for position in node_items:
+        items[position] += len(strings)
+    sections['lengths'] = [len(string) for string in strings]
+
+    block = ''.join(strings).encode('utf-8', 'surrogatepass')
+    packed = [_pack(sections[name]) for name in SECTIONS]
+    counts = []
+    for name, (size, __) in zip(SECTIONS, packed):
+        counts.extend((size, len(sections[name])))
+    return b''.join([
+        HEADER.pack(MAGIC, FORMAT_VERSION, len(block), *counts),
+        block,
+        *[section for __, section in packed],
+    ])
+
+
+def loads(data: bytes) -> Node:
+    """
+    Deserialize a semantic tree from bytes made by dumps.
+
+    Raises ValueError if the data isn't a serialized tree in this format,
+    or is truncated or otherwise corrupt.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Not a serialized semantic tree')
+    magic, version, block_size, *counts = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a serialized semantic tree')
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unsupported serialization version: {version}')
+    offset = HEADER.size + block_size
+    if offset + sum(
+            size * count for size, count in zip(counts[::2], counts[1::2])
+            ) != len(data):
+        raise ValueError('Serialized semantic tree is truncated or corrupt')
+
+    block = data[HEADER.size:offset].decode('utf-8', 'surrogatepass')
+    sections = {}
+    for name, size, count in zip(SECTIONS, counts[::2], counts[1::2]):
+        sections[name] = _unpack(data[offset:offset + size * count], size)
+        offset += size * count
+
+    lengths = sections['lengths']
+    ends = list(accumulate(lengths))
+    if (ends[-1] if ends else 0) != len(block):
+        raise ValueError('Serialized semantic tree is corrupt')
+    strings = [
+        block[end - length:end] for end, length in zip(ends, lengths)
+    ]
+
+    _check(sections, len(strings))
+    try:
+        return _build(sections, strings)
+    except IndexError:
+        raise ValueError('Serialized semantic tree is corrupt')
+
+
+def _check(sections, string_count):
+    """
+    Make sure the node table describes one tree: the counts add up, and
+    every node but the root is an item of exactly one node before it.
+    """
+    names = sections['names']
+    forest_counts = sections['forest_counts']
+    item_counts = sections['item_counts']
+    items = sections['items']
+    node_count = len(names)
+    if (
+            node_count == 0
+            or len(sections['brac_counts']) != node_count
+            or len(forest_counts) != node_count
+            or sum(sections['brac_counts']) != len(sections['bracs'])
+            or sum(forest_counts) != len(item_counts)
+            or sum(item_counts) != len(items)
+            or len(sections['fields']) % 3 != 0
+            ):
+        raise ValueError('Serialized semantic tree is corrupt')
+
+    counts = iter(item_counts)
+    node_item_counts = [sum(islice(counts, count)) for count in forest_counts]
+    # the item index each node's items would have if they were itself
+    owners = chain.from_iterable(map(
+        repeat,
+        range(string_count, string_count + node_count),
+        node_item_counts
+    ))
+    is_node = list(map(string_count.__le__, items))
+    node_items = list(compress(items, is_node))
+    if any(map(le, node_items, compress(owners, is_node))):
+        raise ValueError('Serialized semantic tree is not a tree')
+    if (
+            len(node_items) != node_count - 1
+            or len(set(node_items)) != node_count - 1
+            ):
+        raise ValueError('Serialized semantic tree is not a tree')
+
+
+def _build(sections, strings):
+    names = list(map(strings.__getitem__, sections['names']))
+    brac_ixs = map(strings.__getitem__, sections['bracs'])
+    bracs = [
+        list(islice(brac_ixs, count)) for count in sections['brac_counts']
+    ]
+    children = [[] for __ in names]
+    nodes = list(map(Node, names, children, repeat({}), bracs))
+
+    # whatever an item refers to, looked up in one step
+    table = strings + nodes
+    items = map(table.__getitem__, sections['items'])
+    forests = iter([
+        list(islice(items, count)) for count in sections['item_counts']
+    ])
+    for node_children, count in zip(children, sections['forest_counts']):
+        node_children.extend(islice(forests, count))
+
+    fields = sections['fields']
+    for ix in range(0, len(fields), 3):
+        node = nodes[fields[ix]]
+        if len(node.fields) == 0:
+            node.fields = {} # don't add to the dict shared by default
+        node.fields[strings[fields[ix + 1]]] = fields[ix + 2]
+    return nodes[0]
+
+
+def dump(main_tree: Node, file: BinaryIO):
+    """Serialize a semantic tree into a binary file."""
+    file.write(dumps(main_tree))
+
+
+def load(file: BinaryIO) -> Node:
+    """Deserialize a semantic tree from a binary file."""
+    return loads(file.read())
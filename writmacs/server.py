@@ -0,0 +1,117 @@
+"""
+A long-running expansion daemon on a Unix domain socket. Its client is in
+writmacs.client, and is re-exported here.
+
+Requests and responses are JSON objects, each sent as a frame: a 4-byte
+big-endian length followed by that many bytes of UTF-8. A request holds
+"text" and optionally "target" and any of the BUDGET_KEYS; a response
+holds "output" and "metadata", or "error" if the request was malformed
+or expansion failed. Requests over MAX_FRAME bytes are refused.
+"""
+
+import asyncio
+import json
+from pathlib import Path
+import signal
+import socket
+
+from . import client
+from .batch import warm_up
+from .client import HEADER, ServerError, encode_frame, request
+from .expand import expand
+from .util import flatten_metadata
+
+SOCKET_PATH = Path(client.SOCKET_PATH)
+# largest request accepted, in bytes, so a bad header can't exhaust memory
+MAX_FRAME = 64 * 1024 * 1024
+
+# context keys a request may set to limit its own expansion
+BUDGET_KEYS = ('max_depth', 'max_output', 'max_ratio', 'time_limit')
+
+
+def respond(message: dict) -> dict:
+    """Answer one request the way the daemon would."""
+    context = {'target': message.get('target', 'md')}
+    for key in BUDGET_KEYS:
+        if key in message:
+            context[key] = message[key]
+    try:
+        output, metadata = expand(message['text'], context)
+    except Exception as error:
+        return {'error': f'{type(error).__name__}: {error}'}
+    return {'output': output, 'metadata': flatten_metadata(metadata)}
+
+
+async def _handle(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(HEADER.size)
+            except asyncio.IncompleteReadError:
+                break # client hung up
+            length, = HEADER.unpack(header)
+            if length > MAX_FRAME:
+                # the rest can't be skipped safely, so hang up after saying
+                writer.write(encode_frame({
+                    'error': f'Request over {MAX_FRAME} bytes'
+                }))
+                await writer.drain()
+                break
+            payload = await reader.readexactly(length)
+            try:
+                message = json.loads(payload)
+            except ValueError as error:
+                answer = {'error': f'Invalid JSON: {error}'}
+            else:
+                if isinstance(message, dict):
+                    # expand elsewhere so other connections aren't kept
+                    # waiting
+                    answer = await loop.run_in_executor(None, respond, message)
+                else:
+                    answer = {'error': 'Request is not a JSON object'}
+            writer.write(encode_frame(answer))
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass # client hung up mid-request
+    finally:
+        writer.close()
+
+
+async def _serve(path: Path):
+    server = await asyncio.start_unix_server(_handle, path=str(path))
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, server.close)
+    async with server:
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass # closed by a signal
+
+
+def serve(path: Path = SOCKET_PATH):
+    """
+    Run the daemon until interrupted, keeping every cache warm.
+
+    Raises FileExistsError if another daemon is already listening at path.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.is_socket():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(path))
+            except OSError:
+                # left over from a daemon that didn't exit cleanly
+                path.unlink()
+            else:
+                raise FileExistsError(
+                    f'A daemon is already listening at {path}'
+                )
+    warm_up()
+    try:
+        asyncio.run(_serve(path))
+    finally:
+        if path.is_socket():
+            path.unlink()
+
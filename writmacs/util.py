@@ -3,9 +3,14 @@ Basic classes/types, constants, and helper functions.
 """
 
 
+from collections import OrderedDict
+import os
 from pathlib import Path
+import pickle
 import pkgutil
 import re
+import threading
+import time
 from typing import *
 
 
@@ -13,56 +18,398 @@ from typing import *
 
 TARGETS = set(['html', 'md', 'txt']) # TODO: should this be an enum?
 LETTERS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+NON_SPACE = re.compile(r'\S')
 
+# nothing is created at import; directories are made once written to
 CONFIG_DIR = Path.home() / '.config'
-if not CONFIG_DIR.exists():
-    CONFIG_DIR.mkdir()
 WRITMACS_DIR = CONFIG_DIR / 'writmacs'
-if not WRITMACS_DIR.exists():
-    WRITMACS_DIR.mkdir()
 SNIPPETS_DIR = WRITMACS_DIR / 'snippets'
-if not SNIPPETS_DIR.exists():
-    SNIPPETS_DIR.mkdir()
 KEYMAPS_DIR = WRITMACS_DIR / 'keymaps'
-if not KEYMAPS_DIR.exists():
-    KEYMAPS_DIR.mkdir()
+CACHE_DIR = WRITMACS_DIR / 'cache'
+PACKAGE_KEYMAPS_DIR = Path(__file__).parent / 'keymaps'
+# bump whenever the pickled form of Keymap changes
+KEYMAP_CACHE_VERSION = 2
 
 # (constants continued at end of file)
 
 ### Types:
 
 class Keymap:
+    """
+    A mapping of input strings to replacements, compiled for matching.
+
+    Keymaps whose keys are all single characters become a str.translate
+    table. Otherwise keys are matched greedily, longest first, with one
+    alternation pattern.
+    """
+
+    __slots__ = ('mapping', 'table', 'pattern')
 
     def __init__(self, mapping):
         self.mapping = mapping
-        self.hints = set()
-        for in_txt in mapping.keys():
-            for depth in range(1, len(in_txt)):
-                self.hints.add(in_txt[:depth])
+        keys = [in_txt for in_txt in mapping.keys() if in_txt != '']
+        if all(len(in_txt) == 1 for in_txt in keys):
+            self.table = str.maketrans({key: mapping[key] for key in keys})
+            self.pattern = None
+        else:
+            self.table = None
+            self.pattern = re.compile('|'.join(
+                re.escape(in_txt)
+                for in_txt in sorted(keys, key=len, reverse=True)
+            ))
+
+    def _replace(self, match):
+        return self.mapping[match.group()]
+
+    def apply(self, txt: str) -> str:
+        """Replace every match in the text."""
+        if self.table is not None:
+            return txt.translate(self.table)
+        return self.pattern.sub(self._replace, txt)
+
+    def apply_reversed(self, txt: str) -> str:
+        """
+        Replace every match in the text and reverse the order of the
+        replacements, leaving each replacement itself intact.
+        """
+        if self.table is not None:
+            return txt[::-1].translate(self.table)
+        units = []
+        left = 0
+        for match in self.pattern.finditer(txt):
+            units.extend(txt[left:match.start()])
+            units.append(self.mapping[match.group()])
+            left = match.end()
+        units.extend(txt[left:])
+        return ''.join(reversed(units))
 
 
 class DB:
+    """
+    A cache of values loaded on demand.
 
-    def __init__(self, fetch):
-        self.fetch = fetch
-        self.cache = {}
+    fetch(key) returns a dict of entries to add, which includes key unless
+    there's no such thing; missing keys read as None. Up to maxsize
+    entries are kept, evicting the least recently used. Misses are
+    remembered for negative_ttl seconds before fetching again, up to
+    maxsize of them too, kept apart so floods of misses can't evict
+    entries.
 
-    def __getitem__(self, key):
-        if key in self.cache:
-            return self.cache[key]
+    If stamp(key) is given it identifies the version of key's source,
+    e.g. a file's mtime, and entries are refetched when it changes. It is
+    rechecked at most every recheck seconds per key.
 
-        self.cache.update(self.fetch(key))
-        if key in self.cache:
-            return self.cache[key]
+    Lookups are thread safe, and concurrent lookups of a key that isn't
+    cached yet wait on one fetch rather than each running their own.
+    """
 
-        return None
+    def __init__(
+            self, fetch, maxsize=None, negative_ttl=60.0, stamp=None,
+            recheck=1.0):
+        self.fetch = fetch
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.stamp = stamp
+        self.recheck = recheck
+        self.cache = OrderedDict()
+        self.missing = OrderedDict() # key -> time it was found missing
+        self.stamps = {} # key -> (stamp, time it was last checked)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._fetching = {} # key -> lock held while fetching it
+
+    def _current(self, key):
+        """Tell whether key is cached and up to date; hold the lock."""
+        if key not in self.cache and key not in self.missing:
+            return False
+        if key in self.missing:
+            if time.monotonic() - self.missing[key] >= self.negative_ttl:
+                return False
+        if self.stamp is None:
+            return True
+        stamp, checked = self.stamps.get(key, (None, 0.0))
+        now = time.monotonic()
+        if now - checked < self.recheck:
+            return True
+        if self.stamp(key) != stamp:
+            return False
+        self.stamps[key] = (stamp, now)
+        return True
+
+    def __getitem__(self, key):
+        with self._lock:
+            if self._current(key):
+                self.hits += 1
+                if key in self.missing:
+                    self.missing.move_to_end(key)
+                    return None
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            fetching = self._fetching.setdefault(key, threading.Lock())
+
+        with fetching:
+            with self._lock:
+                # another thread may have fetched it while this one waited
+                if self._current(key):
+                    self.hits += 1
+                    return self.cache.get(key)
+                self.misses += 1
+
+            stamp = None if self.stamp is None else self.stamp(key)
+            entries = self.fetch(key)
+
+            with self._lock:
+                now = time.monotonic()
+                for entry_key, value in entries.items():
+                    self.cache[entry_key] = value
+                    self.cache.move_to_end(entry_key)
+                    self.missing.pop(entry_key, None)
+                    if self.stamp is not None:
+                        self.stamps[entry_key] = (
+                            stamp if entry_key == key
+                            else self.stamp(entry_key),
+                            now
+                        )
+                if key not in entries:
+                    self.cache.pop(key, None)
+                    self.missing[key] = now
+                    self.missing.move_to_end(key)
+                    if self.stamp is not None:
+                        self.stamps[key] = (stamp, now)
+                if self.maxsize is not None:
+                    while len(self.cache) > self.maxsize:
+                        evicted, __ = self.cache.popitem(last=False)
+                        self.stamps.pop(evicted, None)
+                        self.evictions += 1
+                    while len(self.missing) > self.maxsize:
+                        evicted, __ = self.missing.popitem(last=False)
+                        self.stamps.pop(evicted, None)
+                self._fetching.pop(key, None)
+            return entries.get(key)
 
     def __contains__(self, key):
         return self[key] is not None
 
+    def invalidate(self, key=None):
+        """Forget one key, or everything if none is given."""
+        with self._lock:
+            if key is None:
+                self.cache.clear()
+                self.missing.clear()
+                self.stamps.clear()
+            else:
+                self.cache.pop(key, None)
+                self.missing.pop(key, None)
+                self.stamps.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SnippetStore:
+    """
+    User snippets, looked up by name without loading every file.
+
+    An index of the byte offset of each name's row is kept on disk and
+    rebuilt per file whenever that file's modification time or size
+    changes (checked at most every recheck seconds). Rows are only read
+    once asked for, and their text is kept ready-escaped per target.
+    """
+
+    INDEX_VERSION = 1
+
+    def __init__(self, parent_dir: Path, index_path: Path, recheck=1.0):
+        self.parent_dir = parent_dir
+        self.index_path = index_path
+        self.recheck = recheck
+        self.files = None # file name -> (mtime, size, {snippet: offset})
+        self.names = {} # snippet name -> (file name, offset)
+        self.entries = {} # snippet name -> {target: text}
+        self.checked = None
+        self._lock = threading.Lock()
+
+    def _load_index(self) -> dict:
+        try:
+            with self.index_path.open('rb') as index_file:
+                version, files = pickle.load(index_file)
+            if version == self.INDEX_VERSION:
+                return files
+        except Exception:
+            pass # missing or corrupt: rebuild it
+        return {}
+
+    def _index_file(self, path: Path) -> dict:
+        offsets = {}
+        offset = 0
+        with path.open('rb') as tsv:
+            for line in tsv:
+                text = line.decode()
+                if not text.startswith('#') and '\t' in text:
+                    before = unescape(text.split('\t', 1)[0])
+                    for alias in before.split(','):
+                        offsets[alias] = offset
+                offset += len(line)
+        return offsets
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.recheck:
+            return
+        self.checked = now
+
+        loaded = self.files is None
+        if loaded:
+            self.files = self._load_index()
+        changed = False
+        stamps = {
+            file_name: (mtime, size)
+            for file_name, mtime, size in dir_stamp(self.parent_dir)
+        }
+        for file_name in list(self.files):
+            if file_name not in stamps:
+                del self.files[file_name]
+                changed = True
+        for file_name, stamp in stamps.items():
+            if self.files.get(file_name, (None, None))[:2] != stamp:
+                offsets = self._index_file(self.parent_dir / file_name)
+                self.files[file_name] = (*stamp, offsets)
+                changed = True
+        if changed or loaded:
+            self._gather(changed)
+
+    def _gather(self, changed: bool):
+        """Map names to rows afresh from the per-file offsets."""
+        self.names = {}
+        for file_name in sorted(self.files):
+            for name, offset in self.files[file_name][2].items():
+                self.names[name] = (file_name, offset)
+        self.entries.clear()
+        if changed:
+            write_cache(self.index_path, (self.INDEX_VERSION, self.files))
+
+    def _reindex(self, file_name: str):
+        """Index one file again now, whatever its stamp says."""
+        path = self.parent_dir / file_name
+        try:
+            stat = path.stat()
+            offsets = self._index_file(path)
+        except OSError:
+            self.files.pop(file_name, None)
+        else:
+            self.files[file_name] = (stat.st_mtime_ns, stat.st_size, offsets)
+        self._gather(True)
+
+    def _read(self, name: str) -> Optional[str]:
+        """
+        Read a snippet's text from its row, or None if the row found there
+        isn't the snippet's, as when its file changed since last indexed.
+        """
+        file_name, offset = self.names[name]
+        try:
+            with (self.parent_dir / file_name).open('rb') as tsv:
+                tsv.seek(offset)
+                line = tsv.readline().decode()
+        except (OSError, UnicodeDecodeError):
+            return None
+        # as read_text would have, with its newline translation
+        if line.endswith('\r\n'):
+            line = line[:-2]
+        elif line.endswith('\n'):
+            line = line[:-1]
+        columns = line.split('\t')
+        if (
+                line.startswith('#') or len(columns) < 2
+                or name not in unescape(columns[0]).split(',')
+                ):
+            return None
+        return unescape(columns[1])
+
+    def get(self, name: str, target: str = None) -> Optional[str]:
+        """
+        Get a snippet's text as it should appear in the given target, or
+        None if there's no such snippet.
+        """
+        with self._lock:
+            self._refresh()
+            if name not in self.entries:
+                if name not in self.names:
+                    return None
+                text = self._read(name)
+                if text is None:
+                    # stale offset: don't wait for the next recheck
+                    self._reindex(self.names[name][0])
+                    if name not in self.names:
+                        return None
+                    text = self._read(name)
+                    if text is None:
+                        return None
+                self.entries[name] = {None: text, 'md': escape_markdown(text)}
+            forms = self.entries[name]
+        return forms.get(target, forms[None])
+
+    def __contains__(self, name):
+        with self._lock:
+            self._refresh()
+            return name in self.names
+
+
+class Memo:
+    """
+    A bounded cache of evaluated subtrees that evicts the least recently
+    used entry once full. Hits and misses are counted to help size it.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class BudgetExceeded(Exception):
+    """A render went over one of the budgets set in its context."""
+
+
+class DepthExceeded(BudgetExceeded):
+    """Macros were nested deeper than max_depth."""
+
+
+class OutputExceeded(BudgetExceeded):
+    """Output grew past max_output, or max_ratio times the source."""
+
+
+class TimeExceeded(BudgetExceeded):
+    """Rendering ran past its time_limit."""
+
 
 class Token:
 
+    __slots__ = ('content', 'fun')
+
     def __init__(self, content, fun=None):
         self.content = content
         self.fun = fun
@@ -70,14 +417,67 @@ class Token:
     def __str__(self):
         if self.fun is None:
             return str(self.content)
-        return str(fun(self.content))
+        return str(self.fun(self.content))
+
+
+class Span:
+    """
+    A stretch of a source string, kept as offsets so the text is only
+    copied out once something needs it as a str.
+    """
+
+    __slots__ = ('source', 'start', 'end')
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        return self.source[self.start:self.end]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def isspace(self):
+        return (
+            self.end > self.start
+            and NON_SPACE.search(self.source, self.start, self.end) is None
+        )
+
+    def lstrip(self):
+        match = NON_SPACE.search(self.source, self.start, self.end)
+        return Span(
+            self.source, self.end if match is None else match.start(), self.end
+        )
+
+    def rstrip(self):
+        end = self.end
+        while end > self.start and self.source[end - 1].isspace():
+            end -= 1
+        return Span(self.source, self.start, end)
 
 
 class Node:
-    def __init__(self, name, children, child_names={}):
+    """
+    A macro invocation, serving both as AST node (with the brackets that
+    enclosed each child in bracs) and as semantic tree node once its
+    children have been organized.
+    """
+
+    __slots__ = (
+        'name', 'children', 'fields', 'bracs', 'resolved', 'fingerprint'
+    )
+
+    def __init__(self, name, children, child_names={}, bracs=()):
         self.name = name
         self.children = children
         self.fields = child_names
+        self.bracs = bracs
+        # (contextualizer, expander) for name, once looked up ahead of time
+        self.resolved = None
+        # (digest of the subtree, whether it uses nondeterministic macros)
+        self.fingerprint = None
 
     def __getitem__(self, key):
         if type(key) is int:
@@ -92,10 +492,10 @@ class Node:
         for ix in range(len(self.children)):
             builder.extend(['\n' + '-' * depth + f'[{ix}]\n'])
             for chunk in self.children[ix]:
-                if type(chunk) is str:
-                    builder.append(chunk)
-                else:
+                if type(chunk) is Node:
                     builder.append(chunk.to_str(depth+1))
+                else:
+                    builder.append(str(chunk))
         builder.append('»')
         return ''.join(builder)
 
@@ -170,38 +570,106 @@ def load_path_mapping(path: Path, alias_sep: str = None) -> dict:
     return rows2mapping(rows)
 
 
-def load_all_path_mappings(parent_dir: Path, alias_sep: str = None) -> dict:
-    """
-    Load unicode mappings from all tab-separated value files in a given
-    directory.
-    """
-    mapping = {}
-    for tsv in parent_dir.iterdir():
-        new_map = load_path_mapping(tsv, alias_sep)
-        mapping.update(new_map)
-    return mapping
-
-
-def load_snippets() -> Mapping[str, str]:
-    """Load all user snippets."""
-    return load_all_path_mappings(SNIPPETS_DIR, alias_sep=',')
-
-
-def load_keymap(name: str) -> Keymap:
-    """Load up a particular Keymap by name."""
-    '-> keymap'
+def compile_keymap(name: str) -> Keymap:
+    """Load up a particular Keymap by name, parsing its TSV file."""
 
     users_version = KEYMAPS_DIR / f'{name}.tsv'
     if users_version.exists():
         return Keymap(load_path_mapping(users_version))
 
-    default_res = pkgutil.get_data(__name__, f'keymaps/{name}.tsv')
+    try:
+        default_res = pkgutil.get_data(__name__, f'keymaps/{name}.tsv')
+    except OSError:
+        default_res = None
     if default_res is not None:
         return Keymap(rows2mapping(load_unicode_tsv(default_res.decode())))
 
     raise KeyError('Keymap file not found: ' + name)
 
 
+def keymap_stamp(name: str) -> Optional[tuple]:
+    """
+    Identify the version of the file a Keymap would be loaded from by
+    its path, modification time, and size. None if it can't be found on
+    disk, e.g. when the package is zipped.
+    """
+    for source in [KEYMAPS_DIR / f'{name}.tsv',
+                   PACKAGE_KEYMAPS_DIR / f'{name}.tsv']:
+        try:
+            stat = source.stat()
+        except OSError:
+            continue
+        return (str(source), stat.st_mtime_ns, stat.st_size)
+    return None
+
+
+def get_keymap(name: str) -> Keymap:
+    """Get a Keymap by name from the cache, loading it if need be."""
+    keymap = KEYMAP_CACHE[name]
+    if keymap is None:
+        raise KeyError('Keymap file not found: ' + name)
+    return keymap
+
+
+def dir_stamp(parent_dir: Path) -> tuple:
+    """
+    Identify the version of a directory's files by their names,
+    modification times, and sizes.
+    """
+    if not parent_dir.is_dir():
+        return ()
+    stamps = []
+    for path in sorted(parent_dir.iterdir()):
+        stat = path.stat()
+        stamps.append((path.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+
+def load_keymap(name: str) -> Keymap:
+    """
+    Load up a particular Keymap by name, reusing the compiled copy
+    cached on disk unless its TSV file has changed since.
+    """
+    stamp = keymap_stamp(name)
+    if stamp is None:
+        return compile_keymap(name)
+
+    cached_version = CACHE_DIR / f'{name}.keymap'
+    try:
+        with cached_version.open('rb') as cache_file:
+            version, cached_stamp, keymap = pickle.load(cache_file)
+        if version == KEYMAP_CACHE_VERSION and cached_stamp == stamp:
+            return keymap
+    except Exception:
+        pass # missing, stale, or corrupt: rebuild it
+
+    keymap = compile_keymap(name)
+    write_cache(cached_version, (KEYMAP_CACHE_VERSION, stamp, keymap))
+    return keymap
+
+
+def write_cache(path: Path, contents: Any):
+    """Pickle something to a file in the on-disk cache, if possible."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write beside the cache and swap it in so readers never see half
+        partial = path.with_suffix(f'.{os.getpid()}.partial')
+        with partial.open('wb') as cache_file:
+            pickle.dump(contents, cache_file)
+        os.replace(partial, path)
+    except OSError:
+        pass # an unwritable cache only costs speed
+
+
+def escape_markdown(text: str) -> str:
+    """Escape characters Markdown would otherwise interpret."""
+    return (text
+        .replace('\\', r'\\')
+        .replace('_', r'\_')
+        .replace('*', r'\*')
+    )
+
+
 ### Macro Makers:
 
 def simple_macro(
@@ -248,36 +716,17 @@ def keymapper(keymap_name: str) -> Macro:
     """
     Given the name of a Keymap, produce a function that applies the
     Keymap to lists of strings.
+
+    The Keymap itself is only loaded the first time the function is used.
     """
-    # if keymap_name not in KEYMAP_CACHE:
-    #     KEYMAP_CACHE[keymap_name] = load_keymap(keymap_name)
-    keymap = KEYMAP_CACHE[keymap_name]
     def fun(fields, __):
-        chunks = fields[0]
+        keymap = get_keymap(keymap_name)
         builder = []
-        for txt in chunks:
-            if not type(txt) is str:
-                builder.append(chunk)
-                continue
-            left = 0
-            right = 1
-            while left < len(txt):
-                valid_answer = right
-                while right <= len(txt):
-                    candidate = txt[left:right]
-                    if candidate in keymap.mapping:
-                        valid_answer = right
-                    if candidate in keymap.hints:
-                        right += 1
-                    else:
-                        break
-                builder.append(
-                        keymap.mapping.get(
-                            txt[left:valid_answer],
-                            txt[left:valid_answer]
-                            ))
-                left = valid_answer
-                right = left + 1
+        for txt in fields[0]:
+            if type(txt) is str:
+                builder.append(keymap.apply(txt))
+            else:
+                builder.append(txt)
         return builder, {}
     return fun
 
@@ -321,22 +770,35 @@ def wrapper(prefix: str, suffix: str = None) -> Macro:
 
 ### Misc Helpers
 
+def flatten_metadata(metadata: Metadata) -> dict:
+    """
+    Join any Builders in metadata into plain strings, e.g. so it can be
+    sent as JSON.
+    """
+    flat = {}
+    for key, value in metadata.items():
+        if isinstance(value, (list, tuple)):
+            value = ''.join([str(chunk) for chunk in value])
+        flat[key] = value
+    return flat
+
+
 def strip_seq(seq):
     left_chomp = 0 # will point at first kept item
     while (
             left_chomp < len(seq)
-            and isinstance(seq[left_chomp], str)
-            and (seq[left_chomp].isspace() or seq[left_chomp] == '')
+            and isinstance(seq[left_chomp], (str, Span))
+            and (seq[left_chomp].isspace() or len(seq[left_chomp]) == 0)
             ):
         left_chomp += 1
 
     right_chomp = 1 # will point at last kept item
     while (
             len(seq) - right_chomp > left_chomp
-            and isinstance(seq[len(seq) - right_chomp], str)
+            and isinstance(seq[len(seq) - right_chomp], (str, Span))
             and (
                 seq[len(seq) - right_chomp].isspace()
-                or seq[len(seq) - right_chomp] == ''
+                or len(seq[len(seq) - right_chomp]) == 0
             )):
         right_chomp += 1
 
@@ -344,19 +806,23 @@ def strip_seq(seq):
     chomped = seq[left_chomp:(len(seq) - right_chomp) + 1]
 
     if len(chomped) > 0:
-        if isinstance(chomped[0], str):
+        if isinstance(chomped[0], (str, Span)):
             chomped[0] = chomped[0].lstrip()
-        if isinstance(chomped[-1], str):
+        if isinstance(chomped[-1], (str, Span)):
             chomped[-1] = chomped[-1].rstrip()
 
     return chomped
 
 ### Constants Again Because Python's Limited Hoisting Can't Handle This
 
-KEYMAP_CACHE = DB(lambda k: {k: load_keymap(k)})
+def _fetch_keymap(name: str) -> dict:
+    try:
+        return {name: load_keymap(name)}
+    except KeyError:
+        return {}
+
+KEYMAP_CACHE = DB(_fetch_keymap, maxsize=64, stamp=keymap_stamp)
 
-# load all snippets regardless of request
-# because discrimination unimplemented
-SNIPPET_CACHE = DB(lambda _: load_snippets)
+SNIPPET_STORE = SnippetStore(SNIPPETS_DIR, CACHE_DIR / 'snippets.index')
 
 